@@ -1,12 +1,18 @@
+import io
 import os
-import json
-import requests
+import gzip
+import orjson
 import tempfile
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Iterator
 from uuid import uuid4
-from pypdf import PdfReader, PdfWriter
-from pypdf.errors import PdfReadError
-from docling.datamodel.accelerator_options import AcceleratorDevice, AcceleratorOptions
-from docling.datamodel.base_models import InputFormat
+import pypdfium2 as pdfium
+from docling.datamodel.base_models import DocumentStream, InputFormat
 from docling.datamodel.pipeline_options import PdfPipelineOptions
 from docling.document_converter import DocumentConverter, PdfFormatOption
 from google.cloud import storage
@@ -18,128 +24,397 @@ load_dotenv()
 
 # Required env: GOOGLE_APPLICATION_CREDENTIALS
 
+# Timeout (connect, read) per operasi socket: read=120 membatasi jeda antar chunk, bukan durasi download
+DOWNLOAD_TIMEOUT = (10, 120)
+# Batas waktu total (detik) satu download, supaya server yang mengirim sangat lambat tidak menggantung seluruh batch
+DOWNLOAD_DEADLINE = float(os.getenv("DOWNLOAD_DEADLINE", "600"))
+
+# Satu session untuk semua download supaya koneksi (TCP+TLS) dipakai ulang, dengan retry untuk error sementara
+# (total=4 berarti 4 retry, jadi maksimal 5 percobaan)
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=4,
+        backoff_factor=1.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+    ),
+)
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+
+# Satu GCS client per proses (session HTTP dan kredensialnya dipakai ulang oleh semua thread upload).
+# Dibuat saat pertama dipakai, jadi worker yang hanya parsing tidak pernah membuatnya
+_storage_client = None
+_storage_lock = threading.Lock()
+
+
+def _get_storage_client() -> storage.Client:
+    """Return the process-wide GCS client, creating it on first use."""
+    global _storage_client
+    with _storage_lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+        return _storage_client
+
+
+# Minimal karakter teks (tanpa whitespace) supaya halaman dianggap punya text layer. Halaman scan sering
+# tetap punya sedikit teks digital (nomor halaman, header, watermark), dan itu tidak boleh melewatkan OCR
+MIN_TEXT_CHARS = int(os.getenv("MIN_TEXT_CHARS", "50"))
+
+# Jumlah halaman yang diekstrak ke memori sebelum dikonversi; membatasi pemakaian memori untuk PDF besar
+PAGE_BATCH = int(os.getenv("PAGE_BATCH", "200"))
+
 class Parser:
     DEFAULT_BUCKET = os.getenv("DEFAULT_BUCKET", "cesgs-dart")
 
+    # Docling converters (keyed by do_ocr) shared by every Parser in this process. They are built
+    # on first use, so pool workers load models after fork/spawn rather than inheriting them.
+    _converters: dict[bool, DocumentConverter] = {}
+    _converters_lock = threading.Lock()
+
+    @property
+    def converter(self) -> DocumentConverter:
+        """Converter without OCR, for pages with an embedded text layer."""
+        return Parser._get_converter(do_ocr=False)
+
+    @property
+    def ocr_converter(self) -> DocumentConverter:
+        """Converter with OCR enabled, for pages without an embedded text layer."""
+        return Parser._get_converter(do_ocr=True)
+
+    @classmethod
+    def _get_converter(cls, do_ocr: bool) -> DocumentConverter:
+        """Return the process-wide converter for do_ocr, building it once."""
+        with cls._converters_lock:
+            if do_ocr not in cls._converters:
+                cls._converters[do_ocr] = cls._build_converter(do_ocr)
+            return cls._converters[do_ocr]
+
+    @staticmethod
+    def _build_converter(do_ocr: bool) -> DocumentConverter:
+        """Create a Docling converter with table structure enabled and OCR on or off."""
+        pipeline_opts = PdfPipelineOptions()
+        pipeline_opts.do_ocr = do_ocr
+        pipeline_opts.do_table_structure = True
+        pipeline_opts.table_structure_options.do_cell_matching = True
+        return DocumentConverter(
+            format_options={InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_opts)}
+        )
+
     @staticmethod
-    def _download_pdf(url: str) -> str:
-        """Download a PDF from URL and return local path."""
-        response = requests.get(url)
-        response.raise_for_status()
-        tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-        tmp_file.write(response.content)
-        tmp_file.close()
-        return tmp_file.name
+    def _download_pdf(url: str) -> io.BytesIO:
+        """Stream a PDF from URL into memory and return it as BytesIO; raise TimeoutError past DOWNLOAD_DEADLINE."""
+        buffer = io.BytesIO()
+        deadline = time.monotonic() + DOWNLOAD_DEADLINE
+        with _SESSION.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            # iter_content juga membuka gzip/deflate transfer encoding
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                buffer.write(chunk)
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Download exceeded {DOWNLOAD_DEADLINE:.0f}s: {url}")
+        buffer.seek(0)
+        return buffer
 
     @staticmethod
-    def get_pdf_page_count(pdf_path: str) -> int | None:
-        """Return number of pages in PDF or None on error."""
-        if not os.path.exists(pdf_path):
+    def get_pdf_page_count(pdf: str | io.BytesIO) -> int | None:
+        """Return number of pages in PDF (path or BytesIO) or None on error."""
+        if isinstance(pdf, str) and not os.path.exists(pdf):
             return None
         try:
-            reader = PdfReader(pdf_path)
-            return len(reader.pages)
-        except PdfReadError:
+            document = pdfium.PdfDocument(pdf)
+            count = len(document)
+            document.close()
+            return count
+        except pdfium.PdfiumError:
             return None
         except Exception:
             return None
 
     @staticmethod
-    def extract_single_page(input_path: str, page_number: int, output_path: str) -> None:
-        """Extract one page to new PDF file."""
-        if not os.path.exists(input_path):
-            raise FileNotFoundError(f"Input file not found: {input_path}")
-        reader = PdfReader(input_path)
-        total = len(reader.pages)
+    def extract_single_page(document: pdfium.PdfDocument, page_number: int, output: str | io.BytesIO) -> None:
+        """Extract one page of an open PdfDocument to new PDF (file path or BytesIO)."""
+        total = len(document)
         if not (1 <= page_number <= total):
             raise IndexError(f"Page number {page_number} out of range (1-{total})")
-        writer = PdfWriter()
-        writer.add_page(reader.pages[page_number - 1])
-        with open(output_path, "wb") as f:
-            writer.write(f)
+        page_pdf = pdfium.PdfDocument.new()
+        try:
+            page_pdf.import_pages(document, [page_number - 1])
+            page_pdf.save(output)
+        finally:
+            page_pdf.close()
 
     @staticmethod
-    def parse_single_page(input_doc_path: str) -> str:
-        """Run OCR and conversion on single-page PDF and return Markdown text."""
-        pipeline_opts = PdfPipelineOptions()
-        pipeline_opts.do_ocr = False
-        pipeline_opts.do_table_structure = True
-        pipeline_opts.table_structure_options.do_cell_matching = True
-        converter = DocumentConverter(
-            format_options={InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_opts)}
-        )
-        result = converter.convert(input_doc_path)
+    def has_text_layer(page: pdfium.PdfPage) -> bool:
+        """Return True if the page has at least MIN_TEXT_CHARS of selectable text, i.e. does not need OCR."""
+        try:
+            textpage = page.get_textpage()
+            try:
+                text = textpage.get_text_range()
+                return sum(not c.isspace() for c in text) >= MIN_TEXT_CHARS
+            finally:
+                textpage.close()
+        except Exception:
+            return False
+
+    def parse_single_page(self, input_doc_path: str) -> str:
+        """Run conversion on single-page PDF and return Markdown text."""
+        result = self.converter.convert(input_doc_path)
         return result.document.export_to_markdown()
 
     @staticmethod
     def _upload_to_gcs(data: dict | list, bucket_name: str, path: str) -> None:
-        """Upload JSON-serializable object to GCS at specified path with indent for readability."""
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
+        """Upload JSON-serializable object to GCS at specified path as compact, gzip-encoded JSON."""
+        bucket = _get_storage_client().bucket(bucket_name)
         blob = bucket.blob(path)
-        # Dump JSON with indent=4
+        # JSON tanpa spasi lalu gzip; GCS menyajikannya kembali sebagai application/json
+        payload = orjson.dumps(data)
+        blob.content_encoding = "gzip"
         blob.upload_from_string(
-            json.dumps(data, indent=4),
+            gzip.compress(payload, compresslevel=6),
             content_type="application/json"
         )
 
     @staticmethod
-    def parse(source: str, doc_id: str, bucket_name: str = None, testing: bool = False) -> list[dict]:
-        """Parse PDF (path or URL), upload JSON to GCS, return list of page dicts. If testing=True, limit to first 5 pages."""
-        if bucket_name is None:
-            bucket_name = Parser.DEFAULT_BUCKET
+    def _upload_file_to_gcs(file_path: str, bucket_name: str, path: str) -> None:
+        """Upload gzip-compressed JSON file (from parse_to_file) to GCS at specified path."""
+        bucket = _get_storage_client().bucket(bucket_name)
+        blob = bucket.blob(path)
+        blob.content_encoding = "gzip"
+        blob.upload_from_filename(file_path, content_type="application/json")
 
-        local_pdf = Parser._download_pdf(source) if source.startswith(('http://', 'https://')) else source
-        num_pages = Parser.get_pdf_page_count(local_pdf)
-        if num_pages is None:
-            raise ValueError(f"Could not read PDF at {local_pdf}")
+    def _iter_pages(self, source: str, doc_id: str, testing: bool = False, failed_pages: list[int] | None = None) -> Iterator[dict]:
+        """Parse PDF (path or URL) and yield page dicts one by one; numbers of pages that fail are appended to failed_pages. If testing=True, limit to first 10 pages."""
+        pdf = Parser._download_pdf(source) if source.startswith(('http://', 'https://')) else source
+        # buka PDF sekali saja; semua halaman diambil dari dokumen yang sama.
+        # PDF hasil download diberikan sebagai bytes supaya PDFium membacanya langsung dari memori,
+        # bukan lewat callback read() Python ke BytesIO (getvalue() tidak menyalin buffer)
+        if isinstance(pdf, io.BytesIO):
+            pdf = pdf.getvalue()
+        try:
+            document = pdfium.PdfDocument(pdf)
+            num_pages = len(document)
+        except Exception as e:
+            raise ValueError(f"Could not read PDF at {source}") from e
 
         limit = min(num_pages, 10) if testing else num_pages
-        parsed = []
-        for page_number in range(1, limit + 1):
-            # ← Tambahkan baris berikut untuk progress per halaman
-            print(f"Parsing page {page_number}/{limit} of doc_id={doc_id}...", end=" ")
-
-            # ekstrak halaman ke file sementara
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as page_file:
-                page_path = page_file.name
-            Parser.extract_single_page(local_pdf, page_number, page_path)
-            try:
-                text = Parser.parse_single_page(page_path)
-            finally:
-                os.remove(page_path)
 
-            parsed.append({
-                "id": str(uuid4()),
-                "page_content": text,
-                "metadata": {"page_number": page_number, "doc_id": doc_id}
-            })
+        for start in range(1, limit + 1, PAGE_BATCH):
+            # ekstrak satu batch halaman ke buffer di memori dan simpan mapping nama -> nomor halaman.
+            # halaman yang sudah punya text layer tidak perlu OCR; sisanya (hasil scan) lewat converter OCR
+            text_streams = []
+            ocr_streams = []
+            metadata_map = {}
+            for page_number in range(start, min(start + PAGE_BATCH, limit + 1)):
+                buffer = io.BytesIO()
+                Parser.extract_single_page(document, page_number, buffer)
+                buffer.seek(0)
+                name = f"page_{page_number}.pdf"
+                stream = DocumentStream(name=name, stream=buffer)
+                page = document[page_number - 1]
+                if Parser.has_text_layer(page):
+                    text_streams.append(stream)
+                else:
+                    ocr_streams.append(stream)
+                page.close()
+                metadata_map[name] = page_number
 
-            # ← Tampilkan setelah selesai parsing halaman
-            print("Done")
+            # konversi tiap kelompok sekaligus, lalu gabungkan lagi sesuai urutan halaman
+            results = []
+            if text_streams:
+                results.extend(self.converter.convert_all(text_streams, raises_on_error=False))
+            if ocr_streams:
+                results.extend(self.ocr_converter.convert_all(ocr_streams, raises_on_error=False))
+            results.sort(key=lambda res: metadata_map[res.input.file.name])
+
+            for res in results:
+                page_number = metadata_map.get(res.input.file.name)
+                if res.status.name == "FAILURE":
+                    print(f"Failed parsing page {page_number}/{limit} of doc_id={doc_id}")
+                    if failed_pages is not None:
+                        failed_pages.append(page_number)
+                    continue
+                print(f"Parsed page {page_number}/{limit} of doc_id={doc_id}")
+                yield {
+                    "id": str(uuid4()),
+                    "page_content": res.document.export_to_markdown(),
+                    "metadata": {"page_number": page_number, "doc_id": doc_id}
+                }
+
+    def parse(self, source: str, doc_id: str, bucket_name: str = None, testing: bool = False, upload: bool = True) -> list[dict]:
+        """Parse PDF (path or URL), upload JSON to GCS unless upload=False, return list of page dicts. If testing=True, limit to first 10 pages."""
+        if bucket_name is None:
+            bucket_name = Parser.DEFAULT_BUCKET
 
-        gcs_path = f"parsed/{doc_id}.json"
-        Parser._upload_to_gcs(parsed, bucket_name, gcs_path)
+        parsed = list(self._iter_pages(source, doc_id, testing=testing))
+        if upload:
+            gcs_path = f"parsed/{doc_id}.json"
+            Parser._upload_to_gcs(parsed, bucket_name, gcs_path)
 
-        if source.startswith(('http://', 'https://')) and os.path.exists(local_pdf):
-            os.remove(local_pdf)
         return parsed
 
+    def parse_to_file(self, source: str, doc_id: str, testing: bool = False, dir: str = None) -> tuple[str, list[int]]:
+        """Parse PDF (path or URL) and stream pages as a gzip-compressed JSON array into a temp file (in dir, if given); return its path and the numbers of pages that failed."""
+        failed_pages = []
+        tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".json.gz", dir=dir)
+        try:
+            # tulis per halaman supaya seluruh dokumen tidak perlu ditampung di memori
+            with tmp_file, gzip.GzipFile(fileobj=tmp_file, mode="wb", compresslevel=6) as f:
+                f.write(b"[")
+                for i, page in enumerate(self._iter_pages(source, doc_id, testing=testing, failed_pages=failed_pages)):
+                    if i:
+                        f.write(b",")
+                    f.write(orjson.dumps(page))
+                f.write(b"]")
+        except BaseException:
+            os.remove(tmp_file.name)
+            raise
+        return tmp_file.name, failed_pages
+
+
+def load_documents(xlsx_path: str = "documents.xlsx") -> pd.DataFrame:
+    """Load document list, using a parquet cache next to the xlsx that is refreshed when the xlsx changes."""
+    parquet_path = os.path.splitext(xlsx_path)[0] + ".parquet"
+    if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(xlsx_path):
+        return pd.read_parquet(parquet_path)
+    df = pd.read_excel(xlsx_path)
+    try:
+        df.to_parquet(parquet_path, index=False)
+    except Exception as e:
+        # cache hanya optimasi; kalau gagal (mis. pyarrow tidak ada) tetap lanjut dengan xlsx
+        print(f"Could not cache {xlsx_path} to {parquet_path}: {e}")
+        if os.path.exists(parquet_path):
+            os.remove(parquet_path)
+    return df
+
+
+# Log progres: satu baris JSON per dokumen yang selesai, supaya run yang crash bisa dilanjutkan
+PROGRESS_LOG = os.getenv("PROGRESS_LOG", "progress.jsonl")
+_progress_lock = threading.Lock()
+
+
+def load_progress(path: str = PROGRESS_LOG) -> tuple[set[str], set[str]]:
+    """Return (done, retry) doc_ids from the full-run entries of the progress log, by each doc's latest status."""
+    latest = {}
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # baris terakhir bisa terpotong kalau proses mati saat menulis
+                    continue
+                # hasil run testing hanya beberapa halaman pertama, jadi tidak menentukan status dokumen
+                if not entry.get("testing", False):
+                    latest[entry["doc_id"]] = entry.get("status")
+    done = {doc_id for doc_id, status in latest.items() if status == "done"}
+    # "partial" (ada halaman gagal), "failed" dan "upload_failed" perlu diulang walaupun blob-nya sudah ada di GCS
+    retry = {doc_id for doc_id, status in latest.items() if status in ("partial", "failed", "upload_failed")}
+    return done, retry
+
+
+def record_progress(
+    doc_id: str,
+    status: str = "done",
+    testing: bool = False,
+    failed_pages: list[int] | None = None,
+    error: str | None = None,
+    source: str | None = None,
+    path: str = PROGRESS_LOG,
+) -> None:
+    """Append one progress entry for doc_id to the progress log; failed entries carry the error and source, partial ones the failed pages."""
+    entry = {"doc_id": doc_id, "status": status, "testing": testing, "ts": time.time()}
+    if failed_pages:
+        entry["failed_pages"] = failed_pages
+    if error is not None:
+        entry["error"] = error
+    if source is not None:
+        entry["source"] = source
+    with _progress_lock, open(path, "ab") as f:
+        f.write(orjson.dumps(entry) + b"\n")
+
+
+# Parser milik masing-masing worker process, dibuat saat dokumen pertama diproses
+_worker_parser = None
+
+
+def _parse_one(source: str, doc_id: str, testing: bool, tmp_dir: str) -> tuple[str, list[int]]:
+    """Parse one document inside a pool worker into a JSON temp file under tmp_dir and return its path and failed pages; uploading is left to the caller."""
+    global _worker_parser
+    if _worker_parser is None:
+        _worker_parser = Parser()
+    return _worker_parser.parse_to_file(source, doc_id, testing=testing, dir=tmp_dir)
+
+
+def _upload_parsed_file(file_path: str, doc_id: str, failed_pages: list[int], testing: bool) -> None:
+    """Upload a parse_to_file result to parsed/{doc_id}.json, record it as done (or partial if pages failed), then delete the local file."""
+    try:
+        Parser._upload_file_to_gcs(file_path, Parser.DEFAULT_BUCKET, f"parsed/{doc_id}.json")
+        status = "partial" if failed_pages else "done"
+        record_progress(doc_id, status=status, testing=testing, failed_pages=failed_pages)
+    finally:
+        os.remove(file_path)
 
 
 if __name__ == "__main__":
-    df = pd.read_excel("documents.xlsx")
+    df = load_documents("documents.xlsx")
     df = df.head(1)
-    total = len(df)
-    print(f"Starting parsing {total} documents...")
-    for idx, row in df.iterrows():
-        source = row["source"]
-        doc_id = str(row["doc_id"])
-        testing = True
-        print(f"[{idx+1}/{total}] Processing doc_id={doc_id}...")
-        try:
-            Parser.parse(source, doc_id, testing=testing)
-            print("Done")
-        except Exception as e:
-            print(f"Error: {e}")
+    docs = [(row.source, str(row.doc_id)) for row in df[["source", "doc_id"]].itertuples(index=False)]
+
+    testing = True
+
+    # lewati dokumen yang sudah selesai menurut progress log lokal atau sudah ada di GCS (cukup satu list RPC).
+    # blob di GCS hanya dipercaya untuk run penuh: run testing menulis ke path yang sama tetapi hanya
+    # berisi beberapa halaman pertama, jadi hasilnya tidak boleh dianggap selesai.
+    # progress log menang atas blob: dokumen yang terakhir tercatat partial/gagal tetap diproses ulang.
+    done, retry = load_progress()
+    existing = set()
+    if not testing:
+        bucket = _get_storage_client().bucket(Parser.DEFAULT_BUCKET)
+        existing = {blob.name for blob in bucket.list_blobs(prefix="parsed/")}
+    pending = [
+        (source, doc_id) for source, doc_id in docs
+        if doc_id not in done and (doc_id in retry or f"parsed/{doc_id}.json" not in existing)
+    ]
+    skipped = len(docs) - len(pending)
+    docs = pending
+
+    total = len(docs)
+    print(f"Starting parsing {total} documents ({skipped} already parsed, skipped)...")
+
+    max_workers = max(1, min(os.cpu_count() or 1, total))
+    # upload ke GCS jalan di thread terpisah supaya tidak menahan parsing dokumen berikutnya.
+    # File JSON sementara ditaruh di satu direktori per run yang selalu dihapus di akhir,
+    # termasuk sisa file dari worker yang mati di tengah jalan.
+    with tempfile.TemporaryDirectory(prefix="parsed-") as tmp_dir, \
+            ProcessPoolExecutor(max_workers=max_workers, max_tasks_per_child=4) as executor, \
+            ThreadPoolExecutor(max_workers=8) as upload_executor:
+        futures = {
+            executor.submit(_parse_one, source, doc_id, testing, tmp_dir): (source, doc_id)
+            for source, doc_id in docs
+        }
+        uploads = {}
+        for idx, future in enumerate(as_completed(futures), 1):
+            source, doc_id = futures[future]
+            try:
+                file_path, failed_pages = future.result()
+            except Exception as e:
+                print(f"[{idx}/{total}] Error doc_id={doc_id}: {e}")
+                # catat di progress log supaya URL yang gagal bisa dicek tanpa menghentikan batch
+                record_progress(doc_id, status="failed", testing=testing, error=str(e), source=source)
+                continue
+            uploads[upload_executor.submit(_upload_parsed_file, file_path, doc_id, failed_pages, testing)] = doc_id
+            print(f"[{idx}/{total}] Parsed doc_id={doc_id}, uploading...")
+
+        for upload in as_completed(uploads):
+            doc_id = uploads[upload]
+            try:
+                upload.result()
+                print(f"Uploaded doc_id={doc_id}")
+            except Exception as e:
+                print(f"Upload error doc_id={doc_id}: {e}")
+                record_progress(doc_id, status="upload_failed", testing=testing, error=str(e))
     print("All documents processed.")
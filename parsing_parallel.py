@@ -1,33 +1,89 @@
+import io
 import os
-import json
+import gzip
+import orjson
 import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Iterator
 from uuid import uuid4
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 from dotenv import load_dotenv
 from google.cloud import storage
 
-from pypdf import PdfReader, PdfWriter
+import pypdfium2 as pdfium
 from docling.document_converter import DocumentConverter, PdfFormatOption
-from docling.datamodel.base_models import InputFormat
+from docling.datamodel.base_models import DocumentStream, InputFormat
 from docling.datamodel.pipeline_options import PdfPipelineOptions
 from docling.backend.docling_parse_v4_backend import DoclingParseV4DocumentBackend
 load_dotenv()
 
+# Pages split into memory before each convert_all call; bounds peak memory on very large PDFs
+PAGE_BATCH = int(os.getenv("PAGE_BATCH", "200"))
+
+# (connect, read) timeout per socket operation: read=120 bounds the gap between chunks, not the whole download
+DOWNLOAD_TIMEOUT = (10, 120)
+# Total time budget (seconds) for one download, so a trickling server can't hang the whole batch
+DOWNLOAD_DEADLINE = float(os.getenv("DOWNLOAD_DEADLINE", "600"))
+
+# One pooled session for all downloads so connections (TCP+TLS) are reused, with retries on transient errors
+# (total=4 means 4 retries, i.e. at most 5 attempts)
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=4,
+        backoff_factor=1.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+    ),
+)
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+
 class Parser:
     DEFAULT_BUCKET = os.getenv("DEFAULT_BUCKET", "cesgs-dart")
 
+    # Docling converter shared by every Parser in this process. It is built on first use,
+    # so pool workers load models after fork/spawn rather than inheriting them.
+    _shared_converter: DocumentConverter | None = None
+    _converter_lock = threading.Lock()
+
     def __init__(self):
-        # Initialize GCS client and Docling converter once
-        self.storage_client = storage.Client()
+        # GCS client and Docling converter are both built on first use, so pool
+        # workers that only parse never create a storage client
+        self._storage_client: storage.Client | None = None
+        self._storage_lock = threading.Lock()
 
+    @property
+    def storage_client(self) -> storage.Client:
+        """GCS client for this Parser, created the first time it is needed."""
+        with self._storage_lock:
+            if self._storage_client is None:
+                self._storage_client = storage.Client()
+            return self._storage_client
+
+    @property
+    def converter(self) -> DocumentConverter:
+        """Process-wide Docling converter, created the first time it is needed."""
+        with Parser._converter_lock:
+            if Parser._shared_converter is None:
+                Parser._shared_converter = self._build_converter()
+            return Parser._shared_converter
+
+    @staticmethod
+    def _build_converter() -> DocumentConverter:
         pipeline_opts = PdfPipelineOptions()
         pipeline_opts.do_ocr = False
         pipeline_opts.do_table_structure = True
         pipeline_opts.table_structure_options.do_cell_matching = True
-
-        self.converter = DocumentConverter(
+        return DocumentConverter(
             format_options={
                 InputFormat.PDF: PdfFormatOption(
                     pipeline_options=pipeline_opts,
@@ -36,100 +92,285 @@ class Parser:
             }
         )
 
-    def _download_pdf(self, url: str) -> Path:
-        """Download a PDF from URL and return local Path."""
-        resp = requests.get(url)
-        resp.raise_for_status()
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-        tmp.write(resp.content)
-        tmp.close()
-        return Path(tmp.name)
+    def _download_pdf(self, url: str) -> io.BytesIO:
+        """
+        Stream a PDF from URL into memory and return it as BytesIO.
+        Raises TimeoutError if the download runs past DOWNLOAD_DEADLINE.
+        """
+        buffer = io.BytesIO()
+        deadline = time.monotonic() + DOWNLOAD_DEADLINE
+        with _SESSION.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as resp:
+            resp.raise_for_status()
+            # iter_content also undoes gzip/deflate transfer encoding
+            for chunk in resp.iter_content(chunk_size=1 << 20):
+                buffer.write(chunk)
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Download exceeded {DOWNLOAD_DEADLINE:.0f}s: {url}")
+        buffer.seek(0)
+        return buffer
 
     def _upload_to_gcs(self, data: list, doc_id: str) -> None:
-        """Upload JSON list to GCS under parsed/{doc_id}.json"""
+        """Upload JSON list to GCS under parsed/{doc_id}.json as compact, gzip-encoded JSON"""
+        bucket = self.storage_client.bucket(self.DEFAULT_BUCKET)
+        blob = bucket.blob(f"parsed/{doc_id}.json")
+        payload = orjson.dumps(data)
+        # GCS stores the gzip bytes and transcodes back to plain JSON for clients that don't accept gzip
+        blob.content_encoding = "gzip"
+        blob.upload_from_string(gzip.compress(payload, compresslevel=6), content_type="application/json")
+
+    def _upload_file_to_gcs(self, path: Path, doc_id: str) -> None:
+        """Upload a gzip-compressed JSON file from parse_to_file to GCS under parsed/{doc_id}.json"""
         bucket = self.storage_client.bucket(self.DEFAULT_BUCKET)
         blob = bucket.blob(f"parsed/{doc_id}.json")
-        blob.upload_from_string(json.dumps(data, indent=4), content_type="application/json")
+        blob.content_encoding = "gzip"
+        blob.upload_from_filename(str(path), content_type="application/json")
 
-    def parse(self, source: str, doc_id: str, testing: bool = False) -> list[dict]:
+    def _iter_pages(
+        self, source: str, doc_id: str, testing: bool = False, failed_pages: list[int] | None = None
+    ) -> Iterator[dict]:
         """
-        Parse PDF by splitting into pages and batch-converting pages.
-        Returns list of page dicts and uploads JSON to GCS.
+        Split PDF into pages, batch-convert them and yield one page dict at a time.
+        Numbers of pages that fail to convert are appended to failed_pages, if given.
         If testing=True, limit to first 5 pages.
         """
-        # 1. Download or use local PDF
+        # 1. Download into memory or use local PDF
         if source.startswith(("http://", "https://")):
-            pdf_path = self._download_pdf(source)
+            pdf = self._download_pdf(source)
         else:
-            pdf_path = Path(source)
+            pdf = Path(source)
 
-        # 2. Read all pages
-        reader = PdfReader(str(pdf_path))
-        total_pages = len(reader.pages)
+        # 2. Open the PDF once with PDFium. Downloaded PDFs are handed over as bytes so PDFium
+        # loads them straight from memory instead of calling back into BytesIO.read() for
+        # every block (getvalue() returns the buffer without copying it)
+        document = pdfium.PdfDocument(str(pdf) if isinstance(pdf, Path) else pdf.getvalue())
+        total_pages = len(document)
         limit = min(total_pages, 5) if testing else total_pages
 
-        # 3. Extract each page to a temp file and track mapping
-        page_paths = []
-        metadata_map = {}
-        for i in range(limit):
-            tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-            writer = PdfWriter()
-            writer.add_page(reader.pages[i])
-            writer.write(tmp)
-            tmp.close()
-            page_paths.append(Path(tmp.name))
-            metadata_map[str(tmp.name)] = i + 1
-
-        # 4. Batch convert all page PDFs
-        # convert_all expects positional args: list of paths, raises_on_error
-        results = self.converter.convert_all(
-            page_paths,
-            raises_on_error=True
-        )
+        for start in range(0, limit, PAGE_BATCH):
+            # 3. Copy the next PAGE_BATCH pages into in-memory single-page PDFs and track mapping
+            streams = []
+            metadata_map = {}
+            for i in range(start, min(start + PAGE_BATCH, limit)):
+                buffer = io.BytesIO()
+                page_pdf = pdfium.PdfDocument.new()
+                page_pdf.import_pages(document, [i])
+                page_pdf.save(buffer)
+                page_pdf.close()
+                buffer.seek(0)
+                name = f"page_{i + 1}.pdf"
+                streams.append(DocumentStream(name=name, stream=buffer))
+                metadata_map[name] = i + 1
 
-        # 5. Collect parsed pages
-        parsed = []
-        for res in results:
-            page_file = str(res.input.file)
-            page_num = metadata_map.get(page_file, None)
-            if res.status.name == "FAILURE":
-                print(f"Failed parsing page {page_num} of doc {doc_id}")
-                continue
-            md = res.document.export_to_markdown()
-            parsed.append({
-                "id": str(uuid4()),
-                "page_content": md,
-                "metadata": {"page_number": page_num, "doc_id": doc_id}
-            })
-            print(f"Parsed page {page_num}/{limit} for doc {doc_id}")
+            # 4. Batch convert the page PDFs.
+            # Failed pages come back as FAILURE results instead of aborting the whole document
+            results = self.converter.convert_all(
+                streams,
+                raises_on_error=False
+            )
 
-        # 6. Upload JSON to GCS
-        self._upload_to_gcs(parsed, doc_id)
+            # 5. Collect parsed pages
+            for res in results:
+                page_num = metadata_map.get(res.input.file.name, None)
+                if res.status.name == "FAILURE":
+                    print(f"Failed parsing page {page_num} of doc {doc_id}")
+                    if failed_pages is not None:
+                        failed_pages.append(page_num)
+                    continue
+                md = res.document.export_to_markdown()
+                print(f"Parsed page {page_num}/{limit} for doc {doc_id}")
+                yield {
+                    "id": str(uuid4()),
+                    "page_content": md,
+                    "metadata": {"page_number": page_num, "doc_id": doc_id}
+                }
 
-        # 7. Cleanup temp files
-        for p in page_paths:
-            try:
-                p.unlink()
-            except OSError:
-                pass
-        if source.startswith(("http://", "https://")):
-            try:
-                pdf_path.unlink()
-            except OSError:
-                pass
+    def parse(self, source: str, doc_id: str, testing: bool = False, upload: bool = True) -> list[dict]:
+        """
+        Parse PDF by splitting into pages and batch-converting pages.
+        Returns list of page dicts and uploads JSON to GCS unless upload=False.
+        If testing=True, limit to first 5 pages.
+        """
+        parsed = list(self._iter_pages(source, doc_id, testing=testing))
+
+        # 6. Upload JSON to GCS
+        if upload:
+            self._upload_to_gcs(parsed, doc_id)
 
         return parsed
 
+    def parse_to_file(
+        self, source: str, doc_id: str, testing: bool = False, dir: Path | None = None
+    ) -> tuple[Path, list[int]]:
+        """
+        Parse PDF like parse(), but stream each page into a gzip-compressed JSON array
+        temp file (in dir, if given) instead of holding the whole document in memory.
+        Returns the file Path and the numbers of pages that failed to convert.
+        """
+        failed_pages = []
+        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".json.gz", dir=dir)
+        try:
+            with tmp, gzip.GzipFile(fileobj=tmp, mode="wb", compresslevel=6) as f:
+                f.write(b"[")
+                for i, page in enumerate(self._iter_pages(source, doc_id, testing=testing, failed_pages=failed_pages)):
+                    if i:
+                        f.write(b",")
+                    f.write(orjson.dumps(page))
+                f.write(b"]")
+        except BaseException:
+            Path(tmp.name).unlink(missing_ok=True)
+            raise
+        return Path(tmp.name), failed_pages
+
+def load_documents(xlsx_path: str = "documents.xlsx") -> pd.DataFrame:
+    """
+    Load the document list from xlsx via a parquet cache stored next to it.
+    The cache is rebuilt whenever the xlsx is newer than it.
+    """
+    parquet_path = Path(xlsx_path).with_suffix(".parquet")
+    if parquet_path.exists() and parquet_path.stat().st_mtime >= Path(xlsx_path).stat().st_mtime:
+        return pd.read_parquet(parquet_path)
+    df = pd.read_excel(xlsx_path)
+    try:
+        df.to_parquet(parquet_path, index=False)
+    except Exception as e:
+        # The cache is only an optimization; keep going from the xlsx if it can't be written
+        print(f"Could not cache {xlsx_path} to {parquet_path}: {e}")
+        parquet_path.unlink(missing_ok=True)
+    return df
+
+
+# Append-only log with one JSON line per finished doc, so a crashed batch can resume
+PROGRESS_LOG = Path(os.getenv("PROGRESS_LOG", "progress.jsonl"))
+_progress_lock = threading.Lock()
+
+
+def load_progress(path: Path = PROGRESS_LOG) -> tuple[set[str], set[str]]:
+    """
+    Return (done, retry) doc_ids according to each doc's latest full-run entry in the progress log.
+    retry holds docs whose latest status is partial, failed or upload_failed.
+    """
+    latest = {}
+    if path.exists():
+        with path.open("rb") as f:
+            for line in f:
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # The last line may be truncated if the process died mid-write
+                    continue
+                # Testing runs only cover the first few pages, so they never decide a doc's status
+                if not entry.get("testing", False):
+                    latest[entry["doc_id"]] = entry.get("status")
+    done = {doc_id for doc_id, status in latest.items() if status == "done"}
+    retry = {doc_id for doc_id, status in latest.items() if status in ("partial", "failed", "upload_failed")}
+    return done, retry
+
+
+def record_progress(
+    doc_id: str,
+    status: str = "done",
+    testing: bool = False,
+    failed_pages: list[int] | None = None,
+    error: str | None = None,
+    source: str | None = None,
+    path: Path = PROGRESS_LOG,
+) -> None:
+    """
+    Append one progress entry for doc_id to the progress log.
+    Failures also record error and source; partial results record the failed pages.
+    """
+    entry = {"doc_id": doc_id, "status": status, "testing": testing, "ts": time.time()}
+    if failed_pages:
+        entry["failed_pages"] = failed_pages
+    if error is not None:
+        entry["error"] = error
+    if source is not None:
+        entry["source"] = source
+    with _progress_lock, path.open("ab") as f:
+        f.write(orjson.dumps(entry) + b"\n")
+
+
+# Per-process Parser, built lazily so Docling models are loaded inside each worker
+_worker_parser = None
+
+
+def _parse_one(source: str, doc_id: str, testing: bool, tmp_dir: Path) -> tuple[Path, list[int]]:
+    """
+    Parse one document inside a pool worker into a JSON temp file under tmp_dir.
+    Returns the file Path and failed page numbers; uploading is left to the caller.
+    """
+    global _worker_parser
+    if _worker_parser is None:
+        _worker_parser = Parser()
+    return _worker_parser.parse_to_file(source, doc_id, testing=testing, dir=tmp_dir)
+
+
+def _upload_parsed_file(uploader: Parser, path: Path, doc_id: str, failed_pages: list[int], testing: bool) -> None:
+    """Upload a parse_to_file result for doc_id, record it as done (or partial), then delete the local file."""
+    try:
+        uploader._upload_file_to_gcs(path, doc_id)
+        status = "partial" if failed_pages else "done"
+        record_progress(doc_id, status=status, testing=testing, failed_pages=failed_pages)
+    finally:
+        path.unlink(missing_ok=True)
+
+
 if __name__ == "__main__":
-    df = pd.read_excel("documents.xlsx")
-    docs = [(row["source"], str(row["doc_id"])) for _, row in df.iterrows()]
+    df = load_documents("documents.xlsx")
+    docs = [(row.source, str(row.doc_id)) for row in df[["source", "doc_id"]].itertuples(index=False)]
 
-    parser = Parser()
-    for idx, (source, doc_id) in enumerate(docs, 1):
-        print(f"[{idx}/{len(docs)}] Processing doc_id={doc_id}...")
-        try:
-            parser.parse(source, doc_id, testing=True)
-            print("Done")
-        except Exception as e:
-            print(f"Error processing {doc_id}: {e}")
+    testing = True
+
+    # This Parser only lists and uploads blobs, so it never builds a Docling converter
+    uploader = Parser()
+
+    # Skip docs finished according to the local progress log or already parsed to GCS;
+    # one list RPC instead of an exists() call per doc. Existing blobs only count on full runs:
+    # testing runs write the same path with just the first few pages, so they are not finished.
+    # The log wins over the blob listing: docs last recorded as partial or failed are parsed again.
+    done, retry = load_progress()
+    existing = set()
+    if not testing:
+        bucket = uploader.storage_client.bucket(Parser.DEFAULT_BUCKET)
+        existing = {blob.name for blob in bucket.list_blobs(prefix="parsed/")}
+    pending = [
+        (source, doc_id) for source, doc_id in docs
+        if doc_id not in done and (doc_id in retry or f"parsed/{doc_id}.json" not in existing)
+    ]
+    print(f"Skipping {len(docs) - len(pending)} already parsed documents")
+    docs = pending
+
+    max_workers = max(1, min(os.cpu_count() or 1, len(docs)))
+    # Uploads run on threads in this process so they overlap with parsing of the remaining docs.
+    # Parsed JSON files go to a per-run temp dir that is always removed on exit, including
+    # files left behind by workers that died mid-write.
+    with tempfile.TemporaryDirectory(prefix="parsed-") as tmp_dir, \
+            ProcessPoolExecutor(max_workers=max_workers, max_tasks_per_child=4) as executor, \
+            ThreadPoolExecutor(max_workers=8) as upload_executor:
+        futures = {
+            executor.submit(_parse_one, source, doc_id, testing, Path(tmp_dir)): (source, doc_id)
+            for source, doc_id in docs
+        }
+        uploads = {}
+        for idx, future in enumerate(as_completed(futures), 1):
+            source, doc_id = futures[future]
+            try:
+                path, failed_pages = future.result()
+            except Exception as e:
+                print(f"[{idx}/{len(docs)}] Error processing {doc_id}: {e}")
+                # Surface the failed source in the progress log instead of aborting the batch
+                record_progress(doc_id, status="failed", testing=testing, error=str(e), source=source)
+                continue
+            upload = upload_executor.submit(_upload_parsed_file, uploader, path, doc_id, failed_pages, testing)
+            uploads[upload] = doc_id
+            print(f"[{idx}/{len(docs)}] Parsed doc_id={doc_id}, uploading...")
+
+        for upload in as_completed(uploads):
+            doc_id = uploads[upload]
+            try:
+                upload.result()
+                print(f"Uploaded doc_id={doc_id}")
+            except Exception as e:
+                print(f"Error uploading {doc_id}: {e}")
+                record_progress(doc_id, status="upload_failed", testing=testing, error=str(e))
     print("All documents processed.")